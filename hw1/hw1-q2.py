@@ -2,12 +2,14 @@ import argparse
 
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy.linalg import get_blas_funcs, lstsq
 
 import utils
 
 
 def distance(analytic_solution, model_params):
-    return np.linalg.norm(analytic_solution - model_params)
+    diff = analytic_solution - model_params
+    return np.sqrt(np.dot(diff, diff))
 
 
 def solve_analytically(X, y):
@@ -23,33 +25,53 @@ def solve_analytically(X, y):
     # X has bias term in the last column
     
     # Compute the weights (last weight corresponds to bias term):
-    # Using pseudo inverse because np.linalg.inv did not work because matrix was singular
-    W = np.linalg.pinv(X.transpose().dot(X)).dot(X.transpose()).dot(y) # (n_features,)
+    # X^T X is singular, so the least squares problem is solved on X itself
+    # with a rank-revealing QR factorization (LAPACK gelsy), which is cheaper
+    # than an SVD and does not form X^T X. The rank cutoff has to be explicit:
+    # with gelsy's default (machine epsilon) near-zero pivots are kept, the
+    # rank is overestimated and the weights blow up
+    cond = max(X.shape) * np.finfo(X.dtype).eps
+    W, *_ = lstsq(X, y, cond=cond, lapack_driver='gelsy', check_finite=False) # (n_features,)
         
     return W
 
 
 class _RegressionModel:
     """
-    Base class that allows evaluation code to be shared between the
-    LinearRegression and NeuralRegression classes. You should not need to alter
-    this class!
+    Base class that allows the training loop and evaluation code to be shared
+    between the LinearRegression and NeuralRegression classes. Subclasses
+    implement _update_batch, which makes one update from a minibatch.
     """
-    def train_epoch(self, X, y, **kwargs):
+    def train_epoch(self, X, y, order=None, batch_size=1, **kwargs):
         """
-        Iterate over (x, y) pairs, compute the weight update for each of them.
-        Keyword arguments are passed to update_weight
+        Iterate over minibatches of (x, y) pairs, compute the weight update for
+        each of them. The default batch of one is per-example SGD, which the
+        default learning rate is tuned for. order, if given, is a permutation
+        of the rows of X giving the order in which to visit them, so that
+        shuffling only copies the rows of one batch at a time. Keyword
+        arguments are passed to _update_batch
+
+        Returns the root mean squared error on X as measured by the forward
+        passes of the epoch (each batch before its update), which spares a
+        separate pass over the training set to evaluate it
         """
-        for x_i, y_i in zip(X, y):
-            self.update_weight(x_i, y_i, **kwargs)
+        squared_error = 0.0
+        for start in range(0, X.shape[0], batch_size):
+            if order is None:
+                batch = slice(start, start + batch_size)
+            else:
+                batch = order[start:start + batch_size]
+            squared_error += self._update_batch(X[batch], y[batch], **kwargs)
+        return np.sqrt(squared_error / X.shape[0])
 
     def evaluate(self, X, y):
         """
         return the mean squared error between the model's predictions for X
         and he ground truth y values
         """
-        yhat = self.predict(X)
-        error = yhat - y
+        # predict returns a fresh array, so the error is computed in place
+        error = self.predict(X)
+        error -= y
         squared_error = np.dot(error, error)
         mean_squared_error = squared_error / y.shape[0]
         return np.sqrt(mean_squared_error)
@@ -68,36 +90,90 @@ class LinearRegression(_RegressionModel):
         This function makes an update to the model weights (in other words,
         self.w).
         """
-        # gradient of mean squared error loss dL/dy_hat = 2*(y_hat-y)
-        grad_loss = 2*(self.predict(x_i) - y_i) # number
+        self._update_batch(x_i[None, :], np.atleast_1d(y_i), learning_rate)
+        return self.w # (n_features,)
 
-        # gradient of y_hat with respect to the parametes d(y_hat)/dw = x_i
-        self.w = self.w - learning_rate * (np.dot(grad_loss, x_i))
+    def _update_batch(self, X_b, y_b, learning_rate=0.001):
+        """
+        X_b (batch_size x n_features), y_b (batch_size): a minibatch
 
-        return self.w # (n_features,)
+        Makes a gradient step on the mean squared error over the minibatch,
+        returning the summed squared error of the batch before the step.
+        """
+        residual = self.predict(X_b) - y_b # (batch_size,)
+        squared_error = np.dot(residual, residual)
+
+        # gradient of mean squared error loss dL/dy_hat = 2*(y_hat-y), where
+        # the factor 2 is folded into the step size with the batch average
+        step = 2 * learning_rate / y_b.shape[0]
+
+        # gradient of y_hat with respect to the parametes d(y_hat)/dw = x_i.
+        # The scalars are folded together before scaling the vector and the
+        # update is made in place
+        self.w -= step * np.dot(X_b.T, residual)
+
+        return squared_error
 
     def predict(self, X):
         return np.dot(X, self.w)
 
 
+# BLAS routines bound once per dtype (f2py routines cannot be pickled)
+_blas_funcs = {}
+
+
+def _gemm_ger(dtype):
+    if dtype not in _blas_funcs:
+        _blas_funcs[dtype] = get_blas_funcs(('gemm', 'ger'), dtype=dtype)
+    return _blas_funcs[dtype]
+
+
 class NeuralRegression(_RegressionModel):
     """
     Q2.2b
     """
-    def __init__(self, n_features, hidden):
+    def __init__(self, n_features, hidden, seed=None):
         """
         In this __init__, you should define the weights of the neural
         regression model (for example, there will probably be one weight
         matrix per layer of the model).
+
+        seed: seed of the np.random.Generator used to initialize the weights,
+        drawn from numpy's global random state (as set by
+        utils.configure_seed) by default
         """
+        if seed is None:
+            seed = np.random.randint(2**31)
+        rng = np.random.default_rng(seed)
         
-        # initialize weight matrices with mu = 0.1 and std = 0.1
-        self.weights = [np.random.normal(0.1, 0.1, size = (n_features, hidden)),
-                        np.random.normal(0.1, 0.1, size = (hidden, 1))]
+        # initialize weight matrices with mu = 0.1 and std = 0.1, in float32
+        shapes = [(n_features, hidden), (hidden, 1)]
+        self.weights = [0.1 + 0.1 * rng.standard_normal(shape, dtype=np.float32)
+                        for shape in shapes]
 
         # initialize bias vectors
-        self.biases = [np.zeros(hidden),
-                       np.zeros(1)]
+        self.biases = [np.zeros(hidden, dtype=np.float32),
+                       np.zeros(1, dtype=np.float32)]
+
+        # scratch buffers for _update_batch, allocated by _scratch
+        self._buffer_rows = 0
+
+    def _scratch(self, n):
+        """
+        Returns per-layer views, for a batch of n examples, of the buffers
+        holding the activations, their gradients and the ReLU masks. The
+        buffers are only reallocated when a larger batch is seen.
+        """
+        if n > self._buffer_rows:
+            dtype = self.weights[0].dtype
+            widths = [W.shape[1] for W in self.weights]
+            self._zs = [np.empty((n, w), dtype=dtype) for w in widths]
+            self._grad_zs = [np.empty((n, w), dtype=dtype) for w in widths]
+            self._masks = [np.empty((n, w), dtype=bool) for w in widths[:-1]]
+            self._buffer_rows = n
+        return ([z[:n] for z in self._zs],
+                [g[:n] for g in self._grad_zs],
+                [m[:n] for m in self._masks])
 
     def update_weight(self, x_i, y_i, learning_rate=0.001):
         """
@@ -105,45 +181,68 @@ class NeuralRegression(_RegressionModel):
 
         This function makes an update to the model weights
         """
+        self._update_batch(x_i[None, :], np.atleast_1d(y_i), learning_rate)
+        return self.weights, self.biases
+
+    def _update_batch(self, X_b, y_b, learning_rate=0.001):
+        """
+        X_b (batch_size x n_feats), y_b (batch_size): a minibatch
+
+        Makes a gradient step on the mean squared error over the minibatch,
+        returning the summed squared error of the batch before the step.
+        Every product is a matrix-matrix product (GEMM) over the whole batch.
+        """
 
-        # forward pass
         num_layers = len(self.weights)
-        hiddens = []
+        zs, grad_zs, masks = self._scratch(X_b.shape[0])
+        gemm, ger = _gemm_ger(self.weights[0].dtype)
+        X_b = np.ascontiguousarray(X_b, dtype=self.weights[0].dtype)
+
+        # forward pass, the ReLU is applied in place so zs holds the hiddens
+        h = X_b
         for i in range(num_layers):
-            h = x_i if i == 0 else hiddens[i-1]
-            z = np.dot(h, self.weights[i]) + self.biases[i]
+            z = zs[i]
+            np.dot(h, self.weights[i], out=z)
+            z += self.biases[i]
             if i < num_layers-1:
-                hiddens.append(np.maximum(z,0))
-        yhat = z
-        
-        # backward pass
-        grad_z = 2*(yhat - y_i) # gradient dL/dz
-        grad_weights = []
-        grad_biases = []
-        
+                # inactive units, for the gradient of the ReLU
+                np.less_equal(z, 0, out=masks[i])
+                np.maximum(z, 0, out=z)
+            h = z
+
+        # backward pass, with the 2 / batch_size of dL/dz folded into the step
+        step = 2 * learning_rate / y_b.shape[0]
+        grad_z = grad_zs[-1]
+        np.subtract(zs[-1], y_b[:, None], out=grad_z)
+        squared_error = np.vdot(grad_z, grad_z)
+
         for i in range(num_layers - 1, -1, -1):
-        
-            h = x_i if i == 0 else hiddens[i-1]
-            # compute gradient of parameters:
-            grad_weights.append(np.dot(h[:,None], grad_z[:,None].T)) # dL/dw
-            grad_biases.append(grad_z) # dL/db
-        
-            # compute gradient of hidden layer after activation function:
-            grad_h = np.dot(grad_z, self.weights[i].T) # dL/dh
-        
-            # compute gradient of hidden layer before activation:
-            # (h > 0) to get the gradient of the ReLU
-            grad_z = grad_h * (h > 0) # dL/dz
-        
-        grad_weights.reverse()
-        grad_biases.reverse()
-        
-        # updating the weights
-        for i in range(num_layers):
-            self.weights[i] -= learning_rate * grad_weights[i]
-            self.biases[i] -= learning_rate * grad_biases[i]
-            
-        return self.weights, self.biases
+
+            h = X_b if i == 0 else zs[i-1]
+            W = self.weights[i]
+
+            if i > 0:
+                # compute gradient of hidden layer after activation function:
+                grad_h = grad_zs[i-1]
+                np.dot(grad_z, W.T, out=grad_h) # dL/dh
+
+                # compute gradient of hidden layer before activation:
+                np.copyto(grad_h, 0, where=masks[i-1]) # dL/dz
+
+            # updating the weights in place, W^T -= step * grad_z^T h (dL/dw)
+            if X_b.shape[0] == 1:
+                self.weights[i] = ger(-step, grad_z[0], h[0],
+                                      a=W.T, overwrite_a=1).T
+            else:
+                self.weights[i] = gemm(-step, grad_z.T, h.T,
+                                       beta=1.0, c=W.T, trans_b=1,
+                                       overwrite_c=1).T
+            self.biases[i] -= step * grad_z.sum(axis=0) # dL/db
+
+            if i > 0:
+                grad_z = grad_h
+
+        return squared_error
 
     def predict(self, X):
         """
@@ -158,15 +257,17 @@ class NeuralRegression(_RegressionModel):
         not any of the intermediate values needed to do backpropagation.
         """
         
-         # forward pass
+        # forward pass, adding the bias and applying the ReLU in place so each
+        # layer allocates a single (n_points, width) array
         num_layers = len(self.weights)
-        hiddens = []
 
+        h = X
         for i in range(num_layers):
-            h = X if i == 0 else hiddens[i-1]
-            z = np.dot(h, self.weights[i]) + self.biases[i]
+            z = np.dot(h, self.weights[i])
+            z += self.biases[i]
             if i < num_layers-1:
-                hiddens.append(np.maximum(z,0)) # ReLU
+                np.maximum(z, 0, out=z) # ReLU
+            h = z
 
         # z (n_points, 1) so we remove last dimension to work with evaluate
         yhat = z.reshape(-1,)
@@ -201,7 +302,11 @@ def main():
                         need to change this value for your plots.""")
     parser.add_argument('-hidden_size', type=int, default=150)
     parser.add_argument('-learning_rate', type=float, default=0.001)
+    parser.add_argument('-batch_size', type=int, default=1,
+                        help="Number of examples per weight update.")
     opt = parser.parse_args()
+    if opt.batch_size < 1:
+        parser.error("-batch_size must be at least 1")
 
     utils.configure_seed(seed=42)
 
@@ -210,6 +315,15 @@ def main():
     train_X, train_y = data["train"]
     test_X, test_y = data["test"]
 
+    # Convert the data once to contiguous arrays in the precision of the model
+    # (single for the network, double for linear regression so that its
+    # analytic solution stays accurate), so no epoch has to copy or convert it
+    dtype = np.float32 if opt.model == 'nn' else np.float64
+    train_X = np.ascontiguousarray(train_X, dtype=dtype)
+    train_y = np.ascontiguousarray(train_y, dtype=dtype)
+    test_X = np.ascontiguousarray(test_X, dtype=dtype)
+    test_y = np.ascontiguousarray(test_y, dtype=dtype)
+
     n_points, n_feats = train_X.shape
 
     # Linear regression has an exact, analytic solution. Implement it in
@@ -227,25 +341,27 @@ def main():
 
     # training loop
     epochs = np.arange(1, opt.epochs + 1)
-    train_losses = []
-    test_losses = []
-    dist_opt = []
+    train_losses = np.empty(opt.epochs)
+    test_losses = np.empty(opt.epochs)
+    if analytic_solution is not None:
+        dist_opt = np.empty(opt.epochs)
     for epoch in epochs:
         print('Epoch %i... ' % epoch)
         train_order = np.random.permutation(train_X.shape[0])
-        train_X = train_X[train_order]
-        train_y = train_y[train_order]
-        model.train_epoch(train_X, train_y, learning_rate=opt.learning_rate)
+        # The train loss comes from the forward passes made while training
+        train_losses[epoch - 1] = model.train_epoch(
+            train_X, train_y, order=train_order, batch_size=opt.batch_size,
+            learning_rate=opt.learning_rate)
 
-        # Evaluate on the train and test data.
-        train_losses.append(model.evaluate(train_X, train_y))
-        test_losses.append(model.evaluate(test_X, test_y))
+        # Evaluate on the test data.
+        test_losses[epoch - 1] = model.evaluate(test_X, test_y)
 
         if analytic_solution is not None:
             model_params = model.w
-            dist_opt.append(distance(analytic_solution, model_params))
+            dist_opt[epoch - 1] = distance(analytic_solution, model_params)
 
-        print('Loss (train): %.3f | Loss (test): %.3f' % (train_losses[-1], test_losses[-1]))
+        print('Loss (train): %.3f | Loss (test): %.3f'
+              % (train_losses[epoch - 1], test_losses[epoch - 1]))
 
     plot(epochs, train_losses, test_losses)
     if analytic_solution is not None: